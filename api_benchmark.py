@@ -1,92 +1,352 @@
+import argparse
+import asyncio
+import diskcache
+import functools
+import hashlib
+import httpx
 import openai
+import orjson
+import os
+import sys
+import tiktoken
 import time
 import yaml
 import json
+from collections import Counter
+from dataclasses import asdict, dataclass
 from datetime import datetime
 from pathlib import Path
+from tenacity import AsyncRetrying, retry_if_exception_type, stop_after_attempt, wait_random_exponential
 from tqdm import tqdm
-from typing import Dict, List, Tuple
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import BinaryIO, Dict, List, Optional, Tuple
+
+# 优先使用libyaml提供的C解析器, 未编译libyaml时回退到纯Python实现
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+# uvloop可降低高并发下的事件循环调度开销, 不可用时回退到asyncio默认事件循环
+uvloop = None
+if sys.platform != 'win32':
+    try:
+        import uvloop
+    except ImportError:
+        pass
+
+# 限流、连接失败及服务端5xx错误视为临时故障, 退避后重试
+_RETRYABLE_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_encoder(model: str) -> tiktoken.Encoding:
+    """获取模型对应的tiktoken编码器, 按模型名缓存以避免重复加载BPE词表
+    
+    Args:
+        model (str): 模型名称
+        
+    Returns:
+        tiktoken.Encoding: 编码器, 未知模型回退到cl100k_base
+    """
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+@functools.lru_cache(maxsize=4096)
+def _cached_token_count(model: str, text: str) -> int:
+    """计算token数量, 相同模型下的相同文本只编码一次
+    
+    Args:
+        model (str): 模型名称
+        text (str): 输入文本
+        
+    Returns:
+        int: token数量
+    """
+    return len(_get_encoder(model).encode(text))
+
+
+@dataclass(slots=True)
+class BenchTask:
+    """单个模型的测试任务"""
+    provider: str
+    model: str
+    params: Dict
+    messages: List[Dict]
+    key: str  # 结果缓存键
+    
+    @property
+    def name(self) -> str:
+        """服务商/模型名, 用作结果的键"""
+        return f"{self.provider}/{self.model}"
+
+
+@dataclass(slots=True)
+class BenchResult:
+    """单个模型的测试结果"""
+    speed: float
+    tokens: int
+    status: str
+    decode_speed: float = 0
+    ttft: float = 0
+    cached_tokens: int = 0
+    attempts: int = 0
+    response: Optional[str] = None
+    reasoning: Optional[str] = None  # 推理模型在正式回答前输出的思考内容
+
 
 class OpenAIBenchmark:
-    def __init__(self, config_path: str = "config.yaml", max_workers: int = 3):
+    def __init__(self, config_path: str = "config.yaml", max_workers: int = 3, force_refresh: bool = False):
         """初始化基准测试工具
         
         Args:
             config_path (str): 配置文件路径
-            max_workers (int): 最大并发线程数
+            max_workers (int): 最大并发请求数
+            force_refresh (bool): 忽略已缓存的测试结果, 重新请求API并刷新缓存
         """
+        # 检查max_workers, 为0时所有任务将永远等待
+        if isinstance(max_workers, bool) or not isinstance(max_workers, int) or max_workers <= 0:
+            raise ValueError(f"max_workers必须为正整数, 当前为: {max_workers!r}")
         self.max_workers = max_workers
+        self.force_refresh = force_refresh
         with open(config_path, 'r', encoding='utf-8') as f:
-            self.config = yaml.safe_load(f)
+            self.config = yaml.load(f, Loader=SafeLoader)
         
         # 检查provider名称是否重复
         provider_names = [p['name'] for p in self.config['providers']]
-        if len(provider_names) != len(set(provider_names)):
-            duplicates = {name for name in provider_names if provider_names.count(name) > 1}
+        counts = Counter(provider_names)
+        duplicates = [name for name, count in counts.items() if count > 1]
+        if duplicates:
             raise ValueError(f"发现重复的provider名称: {', '.join(duplicates)}")
         
-        self.clients = {}
-        for provider in self.config['providers']:
-            self.clients[provider['name']] = openai.OpenAI(
-                api_key=provider['api_key'],
-                base_url=provider.get('base_url')
+        # 检查max_concurrency, 为0时该provider的任务将永远等待
+        for p in self.config['providers']:
+            if 'max_concurrency' in p:
+                value = p['max_concurrency']
+                if isinstance(value, bool) or not isinstance(value, int) or value <= 0:
+                    raise ValueError(f"provider {p['name']} 的max_concurrency必须为正整数, 当前为: {value!r}")
+        
+        # 收集所有模型测试任务, 同一提示语的messages在所有任务间共享
+        messages = [{"role": "user", "content": self.config['test_prompt']}]
+        self._tasks = [
+            BenchTask(
+                provider['name'],
+                model['name'],
+                model['params'],
+                messages,
+                self._cache_key(provider['name'], provider.get('base_url'), model['name'], model['params'])
             )
+            for provider in self.config['providers']
+            for model in provider['models']
+        ]
+        
+        # 事件循环在多次运行(如预热与正式测试)间保持, 连接池随之复用, 由close释放
+        self._loop = uvloop.new_event_loop() if uvloop is not None else asyncio.new_event_loop()
+        self._http = None
+        
+        # 客户端在首次请求对应provider时才创建, 未被测试的provider不产生开销
+        self._client_cfg = {p['name']: (p['api_key'], p.get('base_url')) for p in self.config['providers']}
+        self._clients: Dict[str, openai.AsyncOpenAI] = {}
+        
+        # 每个provider可通过max_concurrency单独限制并发, 未配置时仅受全局并发数限制
+        self._sem = asyncio.Semaphore(self.max_workers)
+        self._sems = {
+            p['name']: asyncio.Semaphore(p.get('max_concurrency', self.max_workers))
+            for p in self.config['providers']
+        }
         
+        # 配置cache_dir后, 相同(provider, API地址, 模型, 提示语, 参数)的测试结果会被复用
+        cache_dir = self.config.get('cache_dir')
+        self._cache = diskcache.Cache(cache_dir) if cache_dir else None
     
-    def _count_tokens(self, text: str) -> int:
-        """简单估算token数量 (实际应使用tiktoken库)
+    def _client(self, name: str) -> openai.AsyncOpenAI:
+        """获取provider对应的OpenAI客户端, 首次使用时创建
+        
+        所有客户端共享同一个HTTP/2连接池, 同一base_url上的并发请求复用连接, 避免重复的TLS握手
+        
+        Args:
+            name (str): 服务商名称
+            
+        Returns:
+            openai.AsyncOpenAI: OpenAI客户端
+        """
+        client = self._clients.get(name)
+        if client is None:
+            if self._http is None:
+                self._http = httpx.AsyncClient(
+                    http2=True,
+                    limits=httpx.Limits(max_connections=1024, max_keepalive_connections=256),
+                    timeout=httpx.Timeout(60.0, connect=10.0)
+                )
+            api_key, base_url = self._client_cfg[name]
+            # 关闭SDK内置重试, 由_bounded统一重试, 避免退避等待被计入延迟且占用并发名额
+            client = openai.AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=self._http, max_retries=0)
+            self._clients[name] = client
+        return client
+    
+    async def aclose(self):
+        """关闭共享的HTTP连接池"""
+        if self._http is not None:
+            await self._http.aclose()
+        self._http = None
+        self._clients = {}
+    
+    async def _shutdown(self):
+        """取消事件循环上未完成的任务, 关闭连接池, 并完成asyncio.run原本负责的清理
+        
+        Ctrl-C中断run_until_complete后, 被中断的任务仍挂在事件循环上, 需先取消并等待其结束;
+        之后关闭流式响应遗留的异步生成器, 并等待asyncio.to_thread使用的默认线程池退出
+        """
+        pending = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        for t in pending:
+            t.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        await self.aclose()
+        await self._loop.shutdown_asyncgens()
+        await self._loop.shutdown_default_executor()
+    
+    def close(self):
+        """取消未完成的任务, 关闭连接池及事件循环, 之后不能再运行测试"""
+        if not self._loop.is_closed():
+            self._loop.run_until_complete(self._shutdown())
+            self._loop.close()
+    
+    def _count_tokens(self, text: str, model: str) -> int:
+        """使用tiktoken计算token数量
         
         Args:
             text (str): 输入文本
+            model (str): 模型名称
             
         Returns:
-            int: 估算的token数量
+            int: token数量
         """
-        return len(text) // 4  # 近似估算
+        return _cached_token_count(model, text)
     
-    def _test_single_model(self, provider_name: str, model_name: str, params: Dict) -> Tuple[float, int, str]:
-        """测试单个模型性能
+    async def _test_single_model_async(self, task: BenchTask) -> BenchResult:
+        """以流式方式测试单个模型性能
         
         Args:
-            provider_name (str): 服务商名称
-            model_name (str): 模型名称
-            params (Dict): 模型参数
+            task (BenchTask): 测试任务
             
         Returns:
-            Tuple[float, int, str]: (tokens/s速度, 总token数, API响应内容)
+            BenchResult: 测试结果
         """
-        client = self.clients[provider_name]
+        client = self._client(task.provider)
+        model_name = task.model
         prompt = self.config['test_prompt']
+        # 请求在最后一个chunk中返回usage, 配置中显式指定时以配置为准
+        params = {'stream_options': {'include_usage': True}, **task.params}
         
-        # 开始计时
-        start_time = time.perf_counter()
+        # 开始计时, 全程使用整数纳秒, 仅在计算速度时做一次除法
+        start_ns = time.perf_counter_ns()
+        first_token_ns = None
         
         # 调用OpenAI API
-        response = client.chat.completions.create(
+        response = await client.chat.completions.create(
             model=model_name,
-            messages=[{"role": "user", "content": prompt}],
+            messages=task.messages,
+            stream=True,
             **params
         )
         
+        parts = []
+        reasoning_parts = []
+        usage = None
+        async for chunk in response:
+            if chunk.choices:
+                delta = chunk.choices[0].delta
+                # 推理模型先流式输出reasoning_content, 首token以任一类内容的首个chunk为准
+                reasoning = getattr(delta, 'reasoning_content', None)
+                if (reasoning or delta.content) and first_token_ns is None:
+                    first_token_ns = time.perf_counter_ns()
+                if reasoning:
+                    reasoning_parts.append(reasoning)
+                if delta.content:
+                    parts.append(delta.content)
+            if getattr(chunk, 'usage', None) is not None:
+                usage = chunk.usage
+        
         # 计算耗时
-        duration = time.perf_counter() - start_time
+        end_ns = time.perf_counter_ns()
+        duration_ns = end_ns - start_ns
+        if first_token_ns is None:
+            first_token_ns = end_ns
+        
+        content = "".join(parts)
+        reasoning = "".join(reasoning_parts) or None
+        ttft = (first_token_ns - start_ns) / 1_000_000_000
+        
+        # 优先使用服务端返回的usage, 缺失时再本地计算token数量
+        if usage is not None:
+            completion_tokens = usage.completion_tokens
+            total_tokens = usage.total_tokens
+            cached_tokens = getattr(getattr(usage, 'prompt_tokens_details', None), 'cached_tokens', 0) or 0
+        else:
+            # 首次使用时需加载(可能还需下载)BPE词表, 放到线程中执行以免阻塞其他正在计时的请求;
+            # 词表加载失败不影响API请求本身的结果, 单独标记
+            try:
+                prompt_tokens = await asyncio.to_thread(self._count_tokens, prompt, model_name)
+                completion_tokens = await asyncio.to_thread(self._count_tokens, (reasoning or '') + content, model_name)
+            except Exception as e:
+                return BenchResult(
+                    0, 0, f'success, token计数失败: {type(e).__name__}: {str(e)}',
+                    ttft=ttft, response=content, reasoning=reasoning
+                )
+            total_tokens = prompt_tokens + completion_tokens
+            cached_tokens = 0
+        
+        # 计算tokens/s: 端到端速度包含网络与排队耗时, 解码速度只统计首token之后的生成阶段
+        decode_ns = end_ns - first_token_ns
+        
+        return BenchResult(
+            total_tokens * 1_000_000_000 / duration_ns,
+            total_tokens,
+            'success',
+            decode_speed=completion_tokens * 1_000_000_000 / decode_ns if decode_ns > 0 else 0,
+            ttft=ttft,
+            cached_tokens=cached_tokens,
+            response=content,
+            reasoning=reasoning
+        )
+    
+    def _open_log(self) -> Tuple[Path, BinaryIO]:
+        """创建本次测试的NDJSON日志文件
         
-        # 计算token数量
-        prompt_tokens = self._count_tokens(prompt)
-        completion_tokens = self._count_tokens(response.choices[0].message.content)
-        total_tokens = prompt_tokens + completion_tokens
+        Returns:
+            Tuple[Path, BinaryIO]: (日志文件路径, 以二进制独占创建模式打开的文件对象)
+        """
+        log_dir = Path("logs")
+        log_dir.mkdir(exist_ok=True)
         
-        # 计算tokens/s
-        speed = total_tokens / duration
+        # 同一实例可多次运行, 文件名精确到微秒并以独占模式创建, 重名时追加序号, 保证每次运行写入独立文件
+        stem = f"benchmark_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}"
+        suffix = 0
+        while True:
+            log_file = log_dir / (f"{stem}.jsonl" if suffix == 0 else f"{stem}_{suffix}.jsonl")
+            try:
+                return log_file, open(log_file, 'xb')
+            except FileExistsError:
+                suffix += 1
+    
+    def _write_log_record(self, log_fh: BinaryIO, record: Dict):
+        """向日志追加一行记录并立即刷新到操作系统缓冲区
         
-        return speed, total_tokens, response.choices[0].message.content
+        Args:
+            log_fh (BinaryIO): 日志文件对象
+            record (Dict): 日志记录
+        """
+        log_fh.write(orjson.dumps(record) + b"\n")
+        log_fh.flush()
     
-    def _save_log(self, results: Dict[str, Dict], responses: Dict[str, str]):
-        """保存JSON格式的测试日志
+    def _save_log(self, log_fh: BinaryIO, results: Dict[str, BenchResult], responses: Dict[str, str]):
+        """在日志末尾写入汇总记录
         
         Args:
-            results (Dict[str, Dict]): 测试结果数据
+            log_fh (BinaryIO): 日志文件对象
+            results (Dict[str, BenchResult]): 测试结果数据
             responses (Dict[str, str]): API响应内容
         """
         log_data = {
@@ -94,92 +354,176 @@ class OpenAIBenchmark:
             "results": results,
             "responses": responses
         }
+        self._write_log_record(log_fh, {"summary": log_data})
+    
+    def _cache_key(self, provider_name: str, base_url: Optional[str], model_name: str, params: Dict) -> str:
+        """计算测试任务的缓存键
         
-        log_dir = Path("logs")
-        log_dir.mkdir(exist_ok=True)
+        Args:
+            provider_name (str): 服务商名称
+            base_url (Optional[str]): API基础地址
+            model_name (str): 模型名称
+            params (Dict): 模型参数
+            
+        Returns:
+            str: 由provider、API地址、模型名、提示语和参数哈希得到的键
+        """
+        payload = [provider_name, base_url, model_name, self.config['test_prompt'], params]
+        return hashlib.blake2b(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+    
+    async def _bounded(self, sem: asyncio.Semaphore, task: BenchTask, use_cache: bool = True) -> Tuple[str, BenchResult]:
+        """在provider并发信号量与全局并发信号量限制下测试单个模型
+        
+        先获取provider信号量再获取全局信号量, 避免受限的provider占用全局并发名额;
+        临时故障按指数退避加随机抖动重试, 退避期间释放并发名额
+        
+        Args:
+            sem (asyncio.Semaphore): 全局并发信号量
+            task (BenchTask): 测试任务
+            use_cache (bool): 是否读写结果缓存
+            
+        Returns:
+            Tuple[str, BenchResult]: (服务商/模型名, 测试结果)
+        """
+        # 命中缓存时直接返回, 不占用并发名额
+        use_cache = use_cache and self._cache is not None
+        if use_cache and not self.force_refresh:
+            cached = self._cache.get(task.key)
+            if cached is not None:
+                return task.name, BenchResult(**{**cached, 'status': 'cached', 'attempts': 0})
+        
+        retrying = AsyncRetrying(
+            retry=retry_if_exception_type(_RETRYABLE_ERRORS),
+            wait=wait_random_exponential(min=1, max=30),
+            stop=stop_after_attempt(5),
+            reraise=True
+        )
+        attempts = 0
+        try:
+            async for attempt in retrying:
+                with attempt:
+                    attempts = attempt.retry_state.attempt_number
+                    async with self._sems[task.provider], sem:
+                        result = await self._test_single_model_async(task)
+        except Exception as e:
+            return task.name, BenchResult(0, 0, f'failed: {type(e).__name__}: {str(e)}', attempts=attempts)
         
-        log_file = log_dir / f"benchmark_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+        result.attempts = attempts
+        if use_cache and result.status == 'success':
+            self._cache[task.key] = asdict(result)
+        return task.name, result
+    
+    async def _run_all(self, log_fh: Optional[BinaryIO] = None, use_cache: bool = True) -> Dict[str, BenchResult]:
+        """在事件循环中并发执行所有测试任务
+        
+        Args:
+            log_fh (Optional[BinaryIO]): 日志文件对象, 每完成一个任务即写入一行记录
+            use_cache (bool): 是否读写结果缓存
+            
+        Returns:
+            Dict[str, BenchResult]: 测试结果 {服务商/模型名: 测试结果}
+        """
+        results: Dict[str, BenchResult] = {}
+        tasks = [asyncio.create_task(self._bounded(self._sem, t, use_cache)) for t in self._tasks]
         
-        with open(log_file, 'w', encoding='utf-8') as f:
-            json.dump(log_data, f, indent=2, ensure_ascii=False)
+        # 限制进度条刷新频率, 每次运行最多重绘约100次
+        progress = tqdm(
+            asyncio.as_completed(tasks),
+            total=len(tasks),
+            mininterval=0.5,
+            miniters=max(1, len(tasks) // 100)
+        )
+        try:
+            for next_done in progress:
+                model_name, result = await next_done
+                results[model_name] = result
+                if log_fh is not None:
+                    self._write_log_record(log_fh, {'model': model_name, **asdict(result), 'ts': time.time()})
+        finally:
+            # 运行被中断或取消时, 取消尚未完成的任务, 避免其残留在事件循环中
+            pending = [t for t in tasks if not t.done()]
+            for t in pending:
+                t.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            progress.close()
         
-        print(f"\n测试日志已保存到: {log_file}")
+        return results
     
-    def run_benchmark(self) -> Dict[str, Dict]:
+    def warmup(self, n: int = 1):
+        """预热: 将每个测试任务执行n轮并丢弃结果
+        
+        提前完成DNS解析、TLS握手及HTTP/2连接建立, 使正式测试的计时不包含这些开销
+        
+        Args:
+            n (int): 预热轮数
+        """
+        tqdm.write(f"预热 {len(self._tasks)} 个模型, 共 {n} 轮...")
+        for _ in range(n):
+            self._loop.run_until_complete(self._run_all(use_cache=False))
+    
+    def run_benchmark(self) -> Dict[str, BenchResult]:
         """运行所有模型的基准测试
         
         Returns:
-            Dict[str, Dict]: 测试结果 {模型名: {速度, token数, 状态}}
+            Dict[str, BenchResult]: 测试结果 {服务商/模型名: 测试结果}
         """
-        results = {}
-        # 收集所有模型测试任务
-        test_tasks = []
-        for provider in self.config['providers']:
-            for model in provider['models']:
-                test_tasks.append({
-                    'provider': provider['name'],
-                    'model_name': model['name'],
-                    'params': model['params']
-                })
-        
-        print(f"开始测试 {len(test_tasks)} 个模型(最大并发数: {self.max_workers})...")
-        
-        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-            futures = {
-                executor.submit(
-                    self._test_single_model,
-                    task['provider'],
-                    task['model_name'],
-                    task['params']
-                ): f"{task['provider']}/{task['model_name']}"
-                for task in test_tasks
-            }
-            
-            for future in tqdm(as_completed(futures), total=len(futures)):
-                model_name = futures[future]
-                try:
-                    speed, tokens, response = future.result()
-                    results[model_name] = {
-                        'speed': round(speed, 2),
-                        'tokens': tokens,
-                        'status': 'success',
-                        'response': response
-                    }
-                except Exception as e:
-                    results[model_name] = {
-                        'speed': 0,
-                        'tokens': 0,
-                        'status': f'failed: {str(e)}'
-                    }
-        
-        # 保存测试日志
-        responses = {
-            model: data.get('response', '')
-            for model, data in results.items()
-            if data['status'] == 'success'
-        }
-        self._save_log(results, responses)
+        tqdm.write(f"开始测试 {len(self._tasks)} 个模型(最大并发数: {self.max_workers})...")
+        
+        # 日志按完成顺序逐条追加, 中途中断也不会丢失已完成的结果
+        log_file, log_fh = self._open_log()
+        with log_fh:
+            try:
+                results = self._loop.run_until_complete(self._run_all(log_fh))
+                
+                # 保存测试日志
+                responses = {
+                    model: result.response
+                    for model, result in results.items()
+                    if result.response is not None
+                }
+                self._save_log(log_fh, results, responses)
+            finally:
+                log_fh.flush()
+                os.fsync(log_fh.fileno())
+        
+        tqdm.write(f"\n测试日志已保存到: {log_file}")
         
         return results
     
-    def print_results(self, results: Dict[str, Dict]):
+    def print_results(self, results: Dict[str, BenchResult]):
         """打印测试结果
         
         Args:
-            results (Dict[str, Dict]): 测试结果
+            results (Dict[str, BenchResult]): 测试结果
         """
-        print("\n=== 测试结果 ===")
-        print(f"{'模型':<20} {'速度(tokens/s)':<15} {'总token数':<10} 状态")
-        print("-" * 60)
-        
-        for model, data in results.items():
-            print(f"{model:<20} {data['speed']:<15.2f} {data['tokens']:<10} {data['status']}")
+        # 拼接完整表格后一次性写出, 避免逐行print
+        lines = [
+            "\n=== 测试结果 ===",
+            f"{'模型':<20} {'首token延迟(s)':<14} {'解码速度(tokens/s)':<18} {'端到端速度(tokens/s)':<20} {'总token数':<10} {'缓存token数':<10} 状态",
+            "-" * 110
+        ]
+        lines.extend(
+            f"{model:<20} {r.ttft:<14.3f} {r.decode_speed:<18.2f} {r.speed:<20.2f} {r.tokens:<10} {r.cached_tokens:<10} {r.status}"
+            for model, r in results.items()
+        )
+        sys.stdout.write("\n".join(lines) + "\n")
+        sys.stdout.flush()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="大模型API测速工具")
+    parser.add_argument("--no-cache", action="store_true", help="忽略已缓存的测试结果, 重新请求所有模型")
+    parser.add_argument("--warmup", type=int, default=0, help="正式测试前的预热轮数")
+    args = parser.parse_args()
+    
     try:
-        benchmark = OpenAIBenchmark(max_workers=4)  # 增加默认并发数
-        results = benchmark.run_benchmark()
-        benchmark.print_results(results)
+        benchmark = OpenAIBenchmark(max_workers=4, force_refresh=args.no_cache)  # 增加默认并发数
+        try:
+            if args.warmup > 0:
+                benchmark.warmup(args.warmup)
+            results = benchmark.run_benchmark()
+            benchmark.print_results(results)
+        finally:
+            benchmark.close()
     except ValueError as e:
         print(f"配置错误: {e}")
         exit(1)
\ No newline at end of file